@@ -1,16 +1,28 @@
 import asyncio
+import heapq
+import html
 import logging
-import sqlite3
-import requests
+import random
+import aiohttp
+import aiosqlite
+import orjson
 from aiogram import Bot, Dispatcher, types, executor
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
+from aiogram.dispatcher.filters import Text
 from aiogram.dispatcher.filters.state import State, StatesGroup
+from aiogram.utils.exceptions import MessageNotModified
+from contextlib import asynccontextmanager, suppress
 from datetime import datetime, timedelta
 import time
 import config
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 # Настройка логов
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -19,90 +31,394 @@ bot = Bot(token=config.TELEGRAM_TOKEN)
 storage = MemoryStorage()
 dp = Dispatcher(bot, storage=storage)
 
-# Подключение к БД
-conn = sqlite3.connect('wb_price_monitor.db')
-cursor = conn.cursor()
+# Максимальная длина сообщения Telegram
+TELEGRAM_MAX_LENGTH = 4096
+NOTIFY_HEADER = "⚠️ <b>Изменение цены!</b>\n\n"
+
+# HTTP-сессия для запросов к Wildberries (создается в on_startup)
+session: aiohttp.ClientSession = None
+
+# Адрес API карточек WB, nm - артикул или список артикулов через ';'
+WB_URL = "https://card.wb.ru/cards/detail?nm={}"
+
+# Сколько артикулов запрашивать у WB за один запрос
+WB_BATCH_SIZE = 100
+
+# Запросов к WB в секунду у фонового обновления кэша
+REFRESH_RPS = 2
+
+# Очередь артикулов на обновление (создается в on_startup)
+refresh_queue: asyncio.Queue = None
+# Артикулы, уже стоящие в расписании обновления
+_scheduled = set()
+# Самый короткий интервал проверки среди подписчиков артикула
+_article_interval = {}
+
+# Кэш цен WB: {артикул: (название, цена в копейках, истекает_в)}
+_price_cache = {}
+# TTL записи кэша: растет, пока цена товара не меняется
+_price_ttl = {}
+
+# Расписание проверок: куча (время следующей проверки, user_id)
+_check_heap = []
+# Актуальное время следующей проверки пользователя, устаревшие записи кучи пропускаются
+_next_check = {}
+# Сколько пользователей проверять за один проход (лимит переменных SQLite)
+CHECK_BATCH_USERS = 500
+# Интервалы проверки пользователей из таблицы settings
+_user_intervals = {}
+# Будит планировщик при появлении более ранней проверки (создается в on_startup)
+_check_wakeup: asyncio.Event = None
 
-# Создание таблиц
-cursor.execute('''
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+background_tasks = []
+
+DB_PATH = 'wb_price_monitor.db'
+
+# WAL-журнал, fsync только на чекпоинтах, кэш страниц ~20 МБ
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL; "
+    "PRAGMA synchronous=NORMAL; "
+    "PRAGMA cache_size=-20000; "
+    "PRAGMA temp_store=MEMORY; "
+    "PRAGMA mmap_size=268435456;"
+)
+
+SCHEMA = """
 CREATE TABLE IF NOT EXISTS products (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     user_id INTEGER NOT NULL,
     article INTEGER NOT NULL,
     name TEXT,
-    current_price REAL,
+    current_price INTEGER,
     last_update DATETIME,
     UNIQUE(user_id, article)
-''')
+);
 
-cursor.execute('''
 CREATE TABLE IF NOT EXISTS price_history (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     product_id INTEGER NOT NULL,
-    price REAL,
+    price INTEGER,
     change_date DATETIME,
     FOREIGN KEY(product_id) REFERENCES products(id)
-''')
-conn.commit()
+);
+
+CREATE TABLE IF NOT EXISTS settings (
+    user_id INTEGER PRIMARY KEY,
+    check_interval INTEGER DEFAULT 1800
+);
+
+-- Индексы для выборок по пользователю и истории по товару
+CREATE INDEX IF NOT EXISTS idx_products_user ON products(user_id);
+CREATE INDEX IF NOT EXISTS idx_history_product ON price_history(product_id);
+"""
+
+async def init_db(db):
+    """Создание таблиц и индексов, вызывается один раз при запуске"""
+    await db.executescript(SCHEMA)
+    await db.commit()
+
+class SqlitePool:
+    """Пул соединений aiosqlite: одно соединение для записи и несколько для чтения"""
+    
+    def __init__(self, path, readers=3):
+        self.path = path
+        self.readers = readers
+        self._writer = None
+        self._write_lock = None
+        self._queue = None
+    
+    async def _connect(self):
+        db = await aiosqlite.connect(self.path)
+        await db.executescript(SQLITE_PRAGMAS)
+        return db
+    
+    async def open(self):
+        # Примитивы создаются внутри запущенного цикла событий
+        self._write_lock = asyncio.Lock()
+        self._queue = asyncio.Queue()
+        self._writer = await self._connect()
+        for _ in range(self.readers):
+            self._queue.put_nowait(await self._connect())
+    
+    async def close(self):
+        while self._queue is not None and not self._queue.empty():
+            await self._queue.get_nowait().close()
+        if self._writer is not None:
+            await self._writer.close()
+    
+    @asynccontextmanager
+    async def acquire(self):
+        """Соединение для чтения"""
+        db = await self._queue.get()
+        try:
+            yield db
+        finally:
+            self._queue.put_nowait(db)
+    
+    @asynccontextmanager
+    async def write(self):
+        """Единственное соединение для записи"""
+        async with self._write_lock:
+            yield self._writer
+
+pool = SqlitePool(DB_PATH)
+
+class RateLimiter:
+    """Token bucket: не больше rate отправок в секунду"""
+    
+    def __init__(self, rate):
+        self.rate = rate
+        self.allowance = rate
+        self.ts = time.monotonic()
+        self.lock = asyncio.Lock()
+    
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.allowance = min(self.rate, self.allowance + (now - self.ts) * self.rate)
+                self.ts = now
+                if self.allowance >= 1:
+                    self.allowance -= 1
+                    return
+                await asyncio.sleep((1 - self.allowance) / self.rate)
+
+# Ограничитель исходящих сообщений (создается в on_startup)
+notif_limiter: RateLimiter = None
 
 class ProductState(StatesGroup):
     waiting_for_article = State()
 
-def get_wb_product_info(article):
+def _cache_get(article):
+    """Неустаревшая запись кэша для артикула или None"""
+    hit = _price_cache.get(article)
+    if hit and hit[2] > time.time():
+        return hit
+    return None
+
+def _max_ttl(article):
+    """Предельный TTL: половина самого короткого интервала среди подписчиков товара"""
+    return _article_interval.get(article, CHECK_INTERVAL) // 2
+
+def _cache_put(article, name, price):
+    """Сохранение цены в кэш с адаптивным TTL"""
+    max_ttl = _max_ttl(article)
+    old = _price_cache.get(article)
+    
+    # Цена не изменилась - удваиваем TTL, но не дольше предельного
+    if old and old[1] == price:
+        ttl = min(_price_ttl.get(article, max_ttl // 2) * 2, max_ttl)
+    else:
+        ttl = max_ttl // 2
+    
+    _price_ttl[article] = ttl
+    _price_cache[article] = (name, price, time.time() + ttl)
+
+def _lower_article_interval(article, interval):
+    """Учет подписчика с интервалом interval: TTL и запись кэша укорачиваются при необходимости"""
+    current = _article_interval.get(article)
+    if current is not None and current <= interval:
+        return
+    _article_interval[article] = interval
+    
+    max_ttl = _max_ttl(article)
+    if _price_ttl.get(article, 0) > max_ttl:
+        _price_ttl[article] = max_ttl
+    hit = _price_cache.get(article)
+    if hit and hit[2] > time.time() + max_ttl:
+        _price_cache[article] = (hit[0], hit[1], time.time() + max_ttl)
+
+async def get_wb_product_info(article):
     """Получение информации о товаре с Wildberries по артикулу"""
-    url = f"https://card.wb.ru/cards/detail?nm={article}"
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36',
-        'Accept': 'application/json'
-    }
+    article = int(article)
+    hit = _cache_get(article)
+    if hit:
+        return hit[0], hit[1], True
     
     try:
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
-        data = response.json()
+        async with session.get(WB_URL.format(article)) as response:
+            response.raise_for_status()
+            data = orjson.loads(await response.read())
         
         if not data.get('data', {}).get('products'):
             return None, None, None
         
         product = data['data']['products'][0]
         name = product.get('name')
+        # Цена в API приходит в копейках, так и храним
         price = product.get('salePriceU')
         
-        # Цена в API приходит в копейках, переводим в рубли
         if price:
-            price = price / 100
+            _cache_put(article, name, price)
         
         return name, price, True
     except Exception as e:
         logger.error(f"Ошибка при получении данных: {e}")
         return None, None, False
 
-@dp.message_handler(commands=['start'])
-async def cmd_start(message: types.Message):
-    keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("➕ Добавить товар", callback_data="add_product"))
-    keyboard.add(InlineKeyboardButton("🗑️ Удалить товар", callback_data="remove_product"))
-    keyboard.add(InlineKeyboardButton("📋 Список товаров", callback_data="list_products"))
-    keyboard.add(InlineKeyboardButton("⚙️ Интервал проверки", callback_data="set_interval"))
+async def _fetch_prices_chunk(chunk):
+    """Один запрос к WB за пачкой артикулов"""
+    async with session.get(WB_URL.format(';'.join(map(str, chunk)))) as response:
+        response.raise_for_status()
+        data = orjson.loads(await response.read())
     
-    await message.answer(
-        "🔔 Добро пожаловать в WB Price Guardian!\n\n"
-        "Я отслеживаю изменения цен ваших товаров на Wildberries и мгновенно уведомляю о любых изменениях.\n\n"
-        "Основные функции:\n"
-        "• Автоматическая проверка цен каждые 30 минут\n"
-        "• Мгновенные уведомления об изменениях\n"
-        "• История изменений цен\n"
-        "• Управление списком товаров\n\n"
-        "Добавьте первый товар по его артикулу WB:",
-        reply_markup=keyboard
+    return data.get('data', {}).get('products') or []
+
+def _store_prices(products):
+    """Разбор товаров из ответа WB с сохранением в кэш: {артикул: (название, цена в копейках)}"""
+    prices = {}
+    for product in products:
+        price = product.get('salePriceU')
+        if price is None:
+            continue
+        name = product.get('name')
+        _cache_put(product['id'], name, price)
+        prices[product['id']] = (name, price)
+    return prices
+
+async def fetch_prices_bulk(articles):
+    """Получение цен пачками по WB_BATCH_SIZE артикулов: {артикул: (название, цена в копейках)}"""
+    prices = {}
+    missing = []
+    for article in articles:
+        hit = _cache_get(article)
+        if hit:
+            prices[article] = hit[:2]
+        else:
+            missing.append(article)
+    
+    chunks = [missing[i:i + WB_BATCH_SIZE] for i in range(0, len(missing), WB_BATCH_SIZE)]
+    results = await asyncio.gather(
+        *(_fetch_prices_chunk(chunk) for chunk in chunks),
+        return_exceptions=True
     )
+    
+    for chunk, result in zip(chunks, results):
+        if isinstance(result, Exception):
+            logger.error(f"Ошибка получения цен для {len(chunk)} товаров: {result}")
+            continue
+        
+        prices.update(_store_prices(result))
+    
+    return prices
+
+def schedule_refresh(article, delay=0):
+    """Постановка артикула в очередь фонового обновления через delay секунд"""
+    _scheduled.add(article)
+    if delay:
+        asyncio.get_running_loop().call_later(delay, refresh_queue.put_nowait, article)
+    else:
+        refresh_queue.put_nowait(article)
+
+async def _refresh_chunk(chunk):
+    """Обновление кэша для пачки артикулов и постановка их в расписание"""
+    # Отбрасываем артикулы, которые больше никто не отслеживает,
+    # и обновляем самый короткий интервал их подписчиков
+    placeholders = ','.join('?' * len(chunk))
+    async with pool.acquire() as db:
+        rows = await db.execute_fetchall(
+            "SELECT products.article, MIN(COALESCE(settings.check_interval, ?)) "
+            "FROM products LEFT JOIN settings ON settings.user_id = products.user_id "
+            f"WHERE products.article IN ({placeholders}) GROUP BY products.article",
+            (CHECK_INTERVAL, *chunk)
+        )
+    _article_interval.update(rows)
+    tracked = {article for article, _ in rows}
+    # Вместе с расписанием забываем и кэш, иначе словари только растут
+    for article in set(chunk) - tracked:
+        _article_interval.pop(article, None)
+        _price_cache.pop(article, None)
+        _price_ttl.pop(article, None)
+    _scheduled.difference_update(set(chunk) - tracked)
+    chunk = [article for article in chunk if article in tracked]
+    
+    if chunk:
+        try:
+            _store_prices(await _fetch_prices_chunk(chunk))
+        except Exception as e:
+            logger.error(f"Ошибка обновления цен для {len(chunk)} товаров: {e}")
+        
+        # Обновляем к истечению записи кэша: TTL учитывает и изменчивость цены,
+        # и самый короткий интервал среди подписчиков товара
+        for article in chunk:
+            schedule_refresh(article, _price_ttl.get(article, _max_ttl(article) // 2))
+
+async def price_refresh_task():
+    """Фоновое обновление кэша цен с постоянной частотой запросов к WB"""
+    while True:
+        try:
+            async with pool.acquire() as db:
+                articles = await db.execute_fetchall("SELECT DISTINCT article FROM products")
+            break
+        except Exception as e:
+            logger.exception(f"Ошибка загрузки артикулов для обновления цен: {e}")
+            await asyncio.sleep(60)
+    for (article,) in articles:
+        # Артикул мог уже попасть в расписание из process_article
+        if article not in _scheduled:
+            schedule_refresh(article)
+    
+    while True:
+        # Собираем пачку из тех артикулов, чей срок обновления уже наступил
+        chunk = [await refresh_queue.get()]
+        while len(chunk) < WB_BATCH_SIZE and not refresh_queue.empty():
+            chunk.append(refresh_queue.get_nowait())
+        
+        try:
+            await _refresh_chunk(chunk)
+        except Exception as e:
+            logger.exception(f"Ошибка обновления цен для {len(chunk)} товаров: {e}")
+            # Артикулы остаются в _scheduled, поэтому их нужно вернуть в очередь
+            for article in chunk:
+                schedule_refresh(article, _max_ttl(article) // 2)
+        
+        await asyncio.sleep(1 / REFRESH_RPS)
+
+# Неизменяемые клавиатуры и тексты собираются один раз при загрузке модуля
+START_KB = InlineKeyboardMarkup()
+START_KB.add(InlineKeyboardButton("➕ Добавить товар", callback_data="add_product"))
+START_KB.add(InlineKeyboardButton("🗑️ Удалить товар", callback_data="remove_product"))
+START_KB.add(InlineKeyboardButton("📋 Список товаров", callback_data="list_products"))
+START_KB.add(InlineKeyboardButton("⚙️ Интервал проверки", callback_data="set_interval"))
+
+START_TEXT = (
+    "🔔 Добро пожаловать в WB Price Guardian!\n\n"
+    "Я отслеживаю изменения цен ваших товаров на Wildberries и мгновенно уведомляю о любых изменениях.\n\n"
+    "Основные функции:\n"
+    "• Автоматическая проверка цен каждые 30 минут\n"
+    "• Мгновенные уведомления об изменениях\n"
+    "• История изменений цен\n"
+    "• Управление списком товаров\n\n"
+    "Добавьте первый товар по его артикулу WB:"
+)
+
+INTERVALS = (
+    ("15 минут", 900),
+    ("30 минут", 1800),
+    ("1 час", 3600),
+    ("2 часа", 7200),
+    ("4 часа", 14400),
+    ("6 часов", 21600)
+)
+
+INTERVAL_KB = InlineKeyboardMarkup(row_width=3)
+INTERVAL_KB.add(*(
+    InlineKeyboardButton(text, callback_data=f"interval_{seconds}") for text, seconds in INTERVALS
+))
+
+@dp.message_handler(commands=['start'])
+async def cmd_start(message: types.Message):
+    await message.answer(START_TEXT, reply_markup=START_KB)
 
-@dp.callback_query_handler(lambda c: c.data == 'add_product')
+@dp.callback_query_handler(Text(equals='add_product'))
 async def process_add_product(callback_query: types.CallbackQuery):
     await bot.answer_callback_query(callback_query.id)
-    await bot.send_message(
-        callback_query.from_user.id,
-        "✍️ Введите артикул товара (WB код):"
+    await notif_limiter.acquire()
+    await bot.edit_message_text(
+        "✍️ Введите артикул товара (WB код):",
+        chat_id=callback_query.message.chat.id,
+        message_id=callback_query.message.message_id
     )
     await ProductState.waiting_for_article.set()
 
@@ -117,53 +433,68 @@ async def process_article(message: types.Message, state: FSMContext):
         return
     
     # Проверка существования товара
-    name, price, success = get_wb_product_info(article)
+    name, price, success = await get_wb_product_info(article)
     
     if not success:
-        await message.answer("⚠️ Ошибка подключения к Wildberries. Попробуйте позже.")
+        await message.answer("⚠️ Ошибка подключения к Wildberries. Попробуйте позже.", reply_markup=START_KB)
         await state.finish()
         return
     
     if price is None:
-        await message.answer("❌ Товар с таким артикулом не найден. Проверьте артикул.")
+        await message.answer("❌ Товар с таким артикулом не найден. Проверьте артикул.", reply_markup=START_KB)
         await state.finish()
         return
     
-    # Проверка, не добавлен ли уже товар
-    cursor.execute("SELECT id FROM products WHERE user_id = ? AND article = ?", (user_id, article))
-    if cursor.fetchone():
-        await message.answer("ℹ️ Этот товар уже добавлен в ваш список отслеживания.")
+    current_time = datetime.now().isoformat()
+    async with pool.write() as db:
+        # Проверка и добавление под одной блокировкой записи, иначе два быстрых
+        # сообщения с одним артикулом оба пройдут проверку
+        async with db.execute("SELECT id FROM products WHERE user_id = ? AND article = ?", (user_id, article)) as cur:
+            exists = await cur.fetchone()
+        
+        # Добавление товара в БД
+        if not exists:
+            cur = await db.execute(
+                "INSERT INTO products (user_id, article, name, current_price, last_update) VALUES (?, ?, ?, ?, ?)",
+                (user_id, article, name, price, current_time)
+            )
+            product_id = cur.lastrowid
+            
+            # Сохранение начальной цены в историю
+            await db.execute(
+                "INSERT INTO price_history (product_id, price, change_date) VALUES (?, ?, ?)",
+                (product_id, price, current_time)
+            )
+            await db.commit()
+    
+    if exists:
+        await message.answer("ℹ️ Этот товар уже добавлен в ваш список отслеживания.", reply_markup=START_KB)
         await state.finish()
         return
     
-    # Добавление товара в БД
-    current_time = datetime.now().isoformat()
-    cursor.execute(
-        "INSERT INTO products (user_id, article, name, current_price, last_update) VALUES (?, ?, ?, ?, ?)",
-        (user_id, article, name, price, current_time)
-    )
-    product_id = cursor.lastrowid
-    
-    # Сохранение начальной цены в историю
-    cursor.execute(
-        "INSERT INTO price_history (product_id, price, change_date) VALUES (?, ?, ?)",
-        (product_id, price, current_time)
-    )
-    conn.commit()
+    interval = _user_intervals.get(user_id, CHECK_INTERVAL)
+    _lower_article_interval(int(article), interval)
+    if int(article) not in _scheduled:
+        schedule_refresh(int(article))
+    if user_id not in _next_check:
+        schedule_check(user_id, time.time() + interval)
     
     await message.answer(
         f"✅ Товар успешно добавлен!\n\n"
         f"Название: {name}\n"
         f"Артикул: {article}\n"
-        f"Текущая цена: {price} руб."
+        f"Текущая цена: {price / 100:.2f} руб.",
+        reply_markup=START_KB
     )
     await state.finish()
 
-@dp.callback_query_handler(lambda c: c.data == 'list_products')
+@dp.callback_query_handler(Text(equals='list_products'))
 async def process_list_products(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
-    cursor.execute("SELECT article, name, current_price FROM products WHERE user_id = ?", (user_id,))
-    products = cursor.fetchall()
+    async with pool.acquire() as db:
+        products = await db.execute_fetchall(
+            "SELECT article, name, current_price FROM products WHERE user_id = ?", (user_id,)
+        )
     
     if not products:
         await bot.answer_callback_query(callback_query.id, "У вас нет добавленных товаров.")
@@ -171,20 +502,35 @@ async def process_list_products(callback_query: types.CallbackQuery):
     
     response = "📋 Ваши товары:\n\n"
     for idx, (article, name, price) in enumerate(products, 1):
-        response += f"{idx}. {name}\nАртикул: {article}\nЦена: {price} руб.\n\n"
+        response += f"{idx}. {name}\nАртикул: {article}\nЦена: {price / 100:.2f} руб.\n\n"
     
-    await bot.send_message(user_id, response)
+    await notif_limiter.acquire()
+    # Повторное нажатие на неизменившемся списке Telegram отклоняет как MessageNotModified
+    with suppress(MessageNotModified):
+        await bot.edit_message_text(
+            response,
+            chat_id=callback_query.message.chat.id,
+            message_id=callback_query.message.message_id,
+            reply_markup=START_KB
+        )
 
-@dp.callback_query_handler(lambda c: c.data == 'remove_product')
-async def process_remove_product(callback_query: types.CallbackQuery):
+@dp.callback_query_handler(Text(equals='remove_product'))
+async def process_remove_product(callback_query: types.CallbackQuery, state: FSMContext):
     user_id = callback_query.from_user.id
-    cursor.execute("SELECT id, article, name FROM products WHERE user_id = ?", (user_id,))
-    products = cursor.fetchall()
+    async with pool.acquire() as db:
+        products = await db.execute_fetchall(
+            "SELECT id, article, name FROM products WHERE user_id = ?", (user_id,)
+        )
     
     if not products:
         await bot.answer_callback_query(callback_query.id, "У вас нет добавленных товаров.")
         return
     
+    # Запоминаем товары, чтобы подтверждение обошлось без запроса к БД
+    await state.update_data(products={
+        product_id: (name, article) for product_id, article, name in products
+    })
+    
     keyboard = InlineKeyboardMarkup(row_width=1)
     for product_id, article, name in products:
         # Обрезаем длинное название для кнопки
@@ -194,17 +540,28 @@ async def process_remove_product(callback_query: types.CallbackQuery):
             callback_data=f"remove_{product_id}"
         ))
     
-    await bot.send_message(
-        user_id,
+    await notif_limiter.acquire()
+    await bot.edit_message_text(
         "Выберите товар для удаления:",
+        chat_id=callback_query.message.chat.id,
+        message_id=callback_query.message.message_id,
         reply_markup=keyboard
     )
 
-@dp.callback_query_handler(lambda c: c.data.startswith('remove_'))
-async def confirm_remove(callback_query: types.CallbackQuery):
+@dp.callback_query_handler(Text(startswith='remove_'))
+async def confirm_remove(callback_query: types.CallbackQuery, state: FSMContext):
     product_id = callback_query.data.split('_')[1]
-    cursor.execute("SELECT name, article FROM products WHERE id = ?", (product_id,))
-    product = cursor.fetchone()
+    data = await state.get_data()
+    product = data.get('products', {}).get(int(product_id))
+    
+    # Данных в FSM может не быть, например после перезапуска бота
+    if not product:
+        async with pool.acquire() as db:
+            async with db.execute(
+                "SELECT name, article FROM products WHERE id = ? AND user_id = ?",
+                (product_id, callback_query.from_user.id)
+            ) as cur:
+                product = await cur.fetchone()
     
     if not product:
         await bot.answer_callback_query(callback_query.id, "Товар не найден.")
@@ -215,135 +572,294 @@ async def confirm_remove(callback_query: types.CallbackQuery):
     keyboard.add(InlineKeyboardButton("✅ Да", callback_data=f"confirm_remove_{product_id}"))
     keyboard.add(InlineKeyboardButton("❌ Нет", callback_data="cancel_remove"))
     
-    await bot.send_message(
-        callback_query.from_user.id,
+    await notif_limiter.acquire()
+    await bot.edit_message_text(
         f"Вы уверены, что хотите удалить товар:\n{name} (арт. {article})?",
+        chat_id=callback_query.message.chat.id,
+        message_id=callback_query.message.message_id,
         reply_markup=keyboard
     )
 
-@dp.callback_query_handler(lambda c: c.data.startswith('confirm_remove_'))
-async def remove_product(callback_query: types.CallbackQuery):
+@dp.callback_query_handler(Text(startswith='confirm_remove_'))
+async def remove_product(callback_query: types.CallbackQuery, state: FSMContext):
     product_id = callback_query.data.split('_')[2]
+    # Список товаров для подтверждения больше не нужен и может устареть
+    await state.reset_data()
     
-    cursor.execute("DELETE FROM products WHERE id = ?", (product_id,))
-    cursor.execute("DELETE FROM price_history WHERE product_id = ?", (product_id,))
-    conn.commit()
+    async with pool.write() as db:
+        cur = await db.execute(
+            "DELETE FROM products WHERE id = ? AND user_id = ?",
+            (product_id, callback_query.from_user.id)
+        )
+        deleted = cur.rowcount
+        # Историю чистим, только если товар действительно принадлежал пользователю
+        if deleted:
+            await db.execute("DELETE FROM price_history WHERE product_id = ?", (product_id,))
+        await db.commit()
+    
+    # Товар уже мог быть удален из другого меню
+    if not deleted:
+        await bot.answer_callback_query(callback_query.id, "Товар не найден.")
+        return
     
     await bot.answer_callback_query(callback_query.id, "Товар удален.")
-    await bot.send_message(callback_query.from_user.id, "✅ Товар успешно удален из отслеживания.")
+    await notif_limiter.acquire()
+    await bot.edit_message_text(
+        "✅ Товар успешно удален из отслеживания.",
+        chat_id=callback_query.message.chat.id,
+        message_id=callback_query.message.message_id,
+        reply_markup=START_KB
+    )
 
-@dp.callback_query_handler(lambda c: c.data == 'cancel_remove')
-async def cancel_remove(callback_query: types.CallbackQuery):
+@dp.callback_query_handler(Text(equals='cancel_remove'))
+async def cancel_remove(callback_query: types.CallbackQuery, state: FSMContext):
+    await state.reset_data()
     await bot.answer_callback_query(callback_query.id, "Отменено.")
-    await bot.send_message(callback_query.from_user.id, "Удаление отменено.")
+    await notif_limiter.acquire()
+    await bot.edit_message_text(
+        "Удаление отменено.",
+        chat_id=callback_query.message.chat.id,
+        message_id=callback_query.message.message_id,
+        reply_markup=START_KB
+    )
 
-@dp.callback_query_handler(lambda c: c.data == 'set_interval')
+@dp.callback_query_handler(Text(equals='set_interval'))
 async def set_check_interval(callback_query: types.CallbackQuery):
-    keyboard = InlineKeyboardMarkup(row_width=3)
-    intervals = [
-        ("15 минут", 900),
-        ("30 минут", 1800),
-        ("1 час", 3600),
-        ("2 часа", 7200),
-        ("4 часа", 14400),
-        ("6 часов", 21600)
-    ]
-    
-    for text, seconds in intervals:
-        keyboard.insert(InlineKeyboardButton(text, callback_data=f"interval_{seconds}"))
-    
-    await bot.send_message(
-        callback_query.from_user.id,
+    await notif_limiter.acquire()
+    await bot.edit_message_text(
         "⏱ Выберите интервал проверки цен:",
-        reply_markup=keyboard
+        chat_id=callback_query.message.chat.id,
+        message_id=callback_query.message.message_id,
+        reply_markup=INTERVAL_KB
     )
 
-@dp.callback_query_handler(lambda c: c.data.startswith('interval_'))
+@dp.callback_query_handler(Text(startswith='interval_'))
 async def apply_interval(callback_query: types.CallbackQuery):
-    global CHECK_INTERVAL
     seconds = int(callback_query.data.split('_')[1])
-    CHECK_INTERVAL = seconds
     
     # Сохраняем настройку в БД
     user_id = callback_query.from_user.id
-    cursor.execute("REPLACE INTO settings (user_id, check_interval) VALUES (?, ?)", (user_id, seconds))
-    conn.commit()
+    async with pool.write() as db:
+        await db.execute("REPLACE INTO settings (user_id, check_interval) VALUES (?, ?)", (user_id, seconds))
+        await db.commit()
+    
+    # Следующая проверка - уже по новому интервалу
+    _user_intervals[user_id] = seconds
+    schedule_check(user_id, time.time() + seconds)
+    
+    # Кэш цен товаров пользователя должен успевать за новым интервалом;
+    # увеличение интервала фоновое обновление учтет само
+    async with pool.acquire() as db:
+        articles = await db.execute_fetchall(
+            "SELECT article FROM products WHERE user_id = ?", (user_id,)
+        )
+    for (article,) in articles:
+        _lower_article_interval(article, seconds)
     
     minutes = seconds // 60
     await bot.answer_callback_query(callback_query.id, f"Интервал изменен на {minutes} минут")
-    await bot.send_message(user_id, f"✅ Интервал проверки установлен: {minutes} минут")
+    await notif_limiter.acquire()
+    await bot.edit_message_text(
+        f"✅ Интервал проверки установлен: {minutes} минут",
+        chat_id=callback_query.message.chat.id,
+        message_id=callback_query.message.message_id,
+        reply_markup=START_KB
+    )
+
+def build_notifications(changes):
+    """Склейка изменений в сообщения, не превышающие лимит длины Telegram"""
+    messages = []
+    message = NOTIFY_HEADER
+    for change in changes:
+        if message != NOTIFY_HEADER and len(message) + len(change) + 2 > TELEGRAM_MAX_LENGTH:
+            messages.append(message)
+            message = NOTIFY_HEADER
+        if message != NOTIFY_HEADER:
+            message += "\n\n"
+        message += change
+    messages.append(message)
+    return messages
+
+async def send_notification(user_id, message, semaphore):
+    """Отправка уведомления с ограничением числа одновременных отправок"""
+    async with semaphore:
+        try:
+            await notif_limiter.acquire()
+            await bot.send_message(user_id, message, parse_mode="HTML")
+        except Exception as e:
+            logger.error(f"Ошибка отправки сообщения пользователю {user_id}: {e}")
+
+def schedule_check(user_id, when):
+    """Назначение следующей проверки цен пользователя на момент when"""
+    _next_check[user_id] = when
+    heapq.heappush(_check_heap, (when, user_id))
+    _check_wakeup.set()
+
+async def check_users(user_ids, semaphore):
+    """Проверка цен всех товаров указанных пользователей"""
+    placeholders = ','.join('?' * len(user_ids))
+    async with pool.acquire() as db:
+        articles = await db.execute_fetchall(
+            f"SELECT DISTINCT article FROM products WHERE user_id IN ({placeholders})", user_ids
+        )
+        active = await db.execute_fetchall(
+            f"SELECT DISTINCT user_id FROM products WHERE user_id IN ({placeholders})", user_ids
+        )
+    
+    # Цены берутся из кэша фонового обновления, промахи запрашиваются пачками
+    articles = [article for (article,) in articles]
+    prices = await fetch_prices_bulk(articles)
+    
+    for article in articles:
+        if article not in prices:
+            logger.warning(f"Нет цены для товара {article}, возможно, снят с продажи")
+    
+    changes_by_user = {}
+    current_time = datetime.now().isoformat()
+    
+    # Сравнение цен выполняется в SQLite: в Python попадают только изменившиеся товары
+    changed = f"""
+        FROM products JOIN latest ON products.article = latest.article
+        WHERE products.user_id IN ({placeholders}) AND products.current_price <> latest.price
+    """
+    async with pool.write() as db:
+        await db.execute("CREATE TEMP TABLE IF NOT EXISTS latest (article INTEGER PRIMARY KEY, price INTEGER)")
+        await db.execute("DELETE FROM latest")
+        await db.executemany(
+            "INSERT INTO latest (article, price) VALUES (?, ?)",
+            ((article, price) for article, (_, price) in prices.items())
+        )
+        
+        async with db.execute(
+            "SELECT products.user_id, products.name, products.article, products.current_price, latest.price "
+            + changed, user_ids
+        ) as cur:
+            async for user_id, name, article, old_price, new_price in cur:
+                # Готовим запись для общего уведомления пользователя
+                change = (
+                    f"Товар: {html.escape(name or '')}\n"
+                    f"Артикул: {article}\n\n"
+                    f"Старая цена: <s>{old_price / 100:.2f} руб.</s>\n"
+                    f"Новая цена: <b>{new_price / 100:.2f} руб.</b>\n\n"
+                    f"Разница: {(new_price - old_price) / 100:+.2f} руб."
+                )
+                changes_by_user.setdefault(user_id, []).append(change)
+        
+        # Историю и новые цены пишем одной транзакцией, не выгружая строки в Python
+        if changes_by_user:
+            await db.execute(
+                "INSERT INTO price_history (product_id, price, change_date) "
+                "SELECT products.id, latest.price, ? " + changed,
+                (current_time, *user_ids)
+            )
+            await db.execute(
+                "UPDATE products SET current_price = latest.price, last_update = ? FROM latest "
+                f"WHERE products.article = latest.article AND products.user_id IN ({placeholders}) "
+                "AND products.current_price <> latest.price",
+                (current_time, *user_ids)
+            )
+        await db.commit()
+    
+    # Каждому подписчику - одно сообщение со всеми изменениями
+    await asyncio.gather(*(
+        send_notification(user_id, message, semaphore)
+        for user_id, changes in changes_by_user.items()
+        for message in build_notifications(changes)
+    ))
+    
+    # Пользователи, у которых еще есть товары
+    return {user_id for (user_id,) in active}
 
 async def price_check_task():
-    """Фоновая задача для проверки цен"""
+    """Фоновая задача для проверки цен: у каждого пользователя свой интервал"""
+    # Не больше 25 одновременных отправок при лимите Telegram 30 сообщений/с
+    semaphore = asyncio.Semaphore(25)
+    
+    async with pool.acquire() as db:
+        settings = await db.execute_fetchall("SELECT user_id, check_interval FROM settings")
+        users = await db.execute_fetchall("SELECT DISTINCT user_id FROM products")
+    _user_intervals.update(settings)
+    
+    # Первые проверки разносим по интервалу пользователя: иначе все они
+    # совпадут с начальным заполнением кэша и каждый артикул запросится дважды
+    now = time.time()
+    for (user_id,) in users:
+        schedule_check(user_id, now + random.uniform(0, _user_intervals.get(user_id, CHECK_INTERVAL)))
+    
     while True:
-        logger.info(f"Начало проверки цен. Интервал: {CHECK_INTERVAL} сек")
+        # Ждем ближайшую проверку или появления более ранней
+        _check_wakeup.clear()
+        delay = _check_heap[0][0] - time.time() if _check_heap else None
+        if delay is None or delay > 0:
+            try:
+                await asyncio.wait_for(_check_wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            continue
         
-        # Получаем все товары для отслеживания
-        cursor.execute("SELECT id, user_id, article, name, current_price FROM products")
-        products = cursor.fetchall()
+        # Забираем всех пользователей, чья проверка уже наступила
+        now = time.time()
+        due = []
+        while _check_heap and _check_heap[0][0] <= now:
+            when, user_id = heapq.heappop(_check_heap)
+            if _next_check.get(user_id) == when:
+                # Пока идет проверка, пользователь вне расписания: добавление
+                # товара или смена интервала назначат ему новую проверку
+                del _next_check[user_id]
+                due.append(user_id)
+        if not due:
+            continue
         
-        for product in products:
-            product_id, user_id, article, name, old_price = product
-            
-            # Получаем актуальную цену
-            _, new_price, success = get_wb_product_info(article)
-            
-            if not success:
-                logger.error(f"Ошибка получения цены для товара {article}")
-                continue
+        logger.info(f"Проверка цен для {len(due)} пользователей")
+        for i in range(0, len(due), CHECK_BATCH_USERS):
+            batch = due[i:i + CHECK_BATCH_USERS]
+            try:
+                active = await check_users(batch, semaphore)
+            except Exception as e:
+                logger.exception(f"Ошибка проверки цен для {len(batch)} пользователей: {e}")
+                active = set(batch)
             
-            if new_price is None:
-                logger.warning(f"Товар {article} не найден, возможно, снят с продажи")
-                continue
-            
-            current_time = datetime.now().isoformat()
-            
-            # Если цена изменилась
-            if abs(new_price - old_price) > 0.01:  # Учитываем погрешность округления
-                # Отправляем уведомление
-                message = (
-                    f"⚠️ <b>Изменение цены!</b>\n\n"
-                    f"Товар: {name}\n"
-                    f"Артикул: {article}\n\n"
-                    f"Старая цена: <s>{old_price:.2f} руб.</s>\n"
-                    f"Новая цена: <b>{new_price:.2f} руб.</b>\n\n"
-                    f"Разница: {new_price - old_price:+.2f} руб."
-                )
-                
-                try:
-                    await bot.send_message(user_id, message, parse_mode="HTML")
-                except Exception as e:
-                    logger.error(f"Ошибка отправки сообщения пользователю {user_id}: {e}")
-                
-                # Обновляем цену в БД
-                cursor.execute(
-                    "UPDATE products SET current_price = ?, last_update = ? WHERE id = ?",
-                    (new_price, current_time, product_id)
-                
-                # Сохраняем изменение в историю
-                cursor.execute(
-                    "INSERT INTO price_history (product_id, price, change_date) VALUES (?, ?, ?)",
-                    (product_id, new_price, current_time))
-                
-                conn.commit()
-        
-        # Ожидаем заданный интервал
-        await asyncio.sleep(CHECK_INTERVAL)
+            # Пользователи без товаров выпадают из расписания
+            for user_id in batch:
+                if user_id in active and user_id not in _next_check:
+                    schedule_check(user_id, now + _user_intervals.get(user_id, CHECK_INTERVAL))
 
 async def on_startup(dp):
-    # Создаем таблицу настроек
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS settings (
-        user_id INTEGER PRIMARY KEY,
-        check_interval INTEGER DEFAULT 1800
-    )''')
-    conn.commit()
+    global session, refresh_queue, notif_limiter, _check_wakeup
+    session = aiohttp.ClientSession(
+        headers={
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36',
+            'Accept': 'application/json'
+        },
+        timeout=aiohttp.ClientTimeout(total=10),
+        connector=aiohttp.TCPConnector(limit=50)
+    )
+    
+    await pool.open()
+    async with pool.write() as db:
+        await init_db(db)
     
-    # Запускаем фоновую задачу проверки цен
-    asyncio.create_task(price_check_task())
+    refresh_queue = asyncio.Queue()
+    # Лимит Telegram - 30 сообщений/с, оставляем запас
+    notif_limiter = RateLimiter(25)
+    _check_wakeup = asyncio.Event()
+    
+    # Запускаем фоновые задачи обновления и проверки цен
+    background_tasks.append(asyncio.create_task(price_refresh_task()))
+    background_tasks.append(asyncio.create_task(price_check_task()))
+
+async def on_shutdown(dp):
+    for task in background_tasks:
+        task.cancel()
+    await session.close()
+    await pool.close()
 
 if __name__ == '__main__':
     # Стандартный интервал проверки (30 минут)
     CHECK_INTERVAL = 1800
     
-    executor.start_polling(dp, on_startup=on_startup, skip_updates=True)
+    # Более быстрый цикл событий на базе libuv, если доступен
+    if uvloop is not None:
+        uvloop.install()
+    
+    executor.start_polling(dp, on_startup=on_startup, on_shutdown=on_shutdown, skip_updates=True)